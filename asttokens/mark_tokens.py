@@ -12,26 +12,48 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ast
+import bisect
+import itertools
 import numbers
+import operator
 import sys
 import token
 
-import six
-
 from . import util
 
-# Mapping of matching braces. To find a token here, look up token[:2].
-_matching_pairs_left = {
-  (token.OP, '('): (token.OP, ')'),
-  (token.OP, '['): (token.OP, ']'),
-  (token.OP, '{'): (token.OP, '}'),
+# Token types used below, bound once to save attribute lookups in frequently called code.
+_OP = token.OP
+_NAME = token.NAME
+_NEWLINE = token.NEWLINE
+_ENDMARKER = token.ENDMARKER
+_NUMBER = token.NUMBER
+_STRING = token.STRING
+
+# Types of string constants: unicode and str on Python 2, str and bytes on Python 3.
+_string_types = (type(u''), bytes)
+
+# Brackets (all OP tokens) that come in matching pairs. Each token is classified with a small
+# integer code: 0 for tokens that aren't brackets, 1-3 for the opening brackets below, and 4-6 for
+# the corresponding closing ones, so adding _CLOSE_OFFSET to an opening code gives its pair's code.
+_opening_brackets = ['(', '[', '{']
+_closing_brackets = [')', ']', '}']
+_CLOSE_OFFSET = len(_opening_brackets)
+
+# Mapping of bracket codes. To find a token here, check that it's an OP, and look up its string.
+_bracket_codes = {}
+_bracket_codes.update((s, i + 1) for i, s in enumerate(_opening_brackets))
+_bracket_codes.update((s, i + 1 + _CLOSE_OFFSET) for i, s in enumerate(_closing_brackets))
+
+# Names of node classes (from ast or astroid) that never have children and whose tokens never
+# include brackets, so there are no unmatched brackets to look for.
+_bracket_free_class_names = {
+  'Name', 'AssignName', 'DelName', 'Num', 'Str', 'Bytes', 'NameConstant', 'Constant', 'Const',
+  'Ellipsis', 'Pass', 'Break', 'Continue', 'Global', 'Nonlocal',
 }
 
-_matching_pairs_right = {
-  (token.OP, ')'): (token.OP, '('),
-  (token.OP, ']'): (token.OP, '['),
-  (token.OP, '}'): (token.OP, '{'),
-}
+# Key function used to find the child that extends furthest.
+_last_token_index = operator.attrgetter('last_token.index')
 
 
 class MarkTokens(object):
@@ -41,12 +63,41 @@ class MarkTokens(object):
   """
   def __init__(self, code):
     self._code = code
-    self._methods = util.NodeMethods()
+    # Bracket codes of all tokens, indexed by token index, so that scanning for brackets doesn't
+    # need to inspect the tokens themselves.
+    self._bracket_codes = bytearray(_bracket_codes.get(tok.string, 0) if tok.type == _OP else 0
+                                    for tok in code.tokens)
+    # Sorted indices of just the bracket tokens, to find the brackets in a range using bisect.
+    self._bracket_indices = [i for i, c in enumerate(self._bracket_codes) if c]
+    # Sorted indices of tokens that end a statement, for _find_last_in_stmt(). The last token is
+    # always an ENDMARKER, so a search here always finds one.
+    self._stmt_end_indices = [tok.index for tok in code.tokens
+                              if util.match_token(tok, _NEWLINE) or
+                              util.match_token(tok, _OP, ';') or
+                              tok.type == _ENDMARKER]
     self._iter_children = None
 
   def visit_tree(self, node):
-    self._iter_children = util.iter_children_func(node)
-    util.visit_tree(node, self._visit_before_children, self._visit_after_children)
+    # This is similar to util.visit_tree(), but collects each node's children only once, when
+    # pushing them onto the stack, and hands them to _visit_after_children() as well.
+    self._iter_children = iter_children = util.iter_children_func(node)
+    done = set()
+    # Stack of (node, parent_token, token, children). While children is None, the node hasn't been
+    # visited yet; once set, all the children have been pushed and the node is ready for postvisit.
+    stack = [(node, None, None, None)]
+    while stack:
+      current, parent_token, token, children = stack.pop()
+      if children is None:
+        assert current not in done    # protect against infinite loop in case of a bad tree.
+        done.add(current)
+
+        child_parent_token, token = self._visit_before_children(current, parent_token)
+        children = tuple(iter_children(current))
+        stack.append((current, parent_token, token, children))
+        # Push children in reverse order, so that the first child ends up on top of the stack.
+        stack.extend((child, child_parent_token, None, None) for child in reversed(children))
+      else:
+        self._visit_after_children(current, parent_token, token, children)
 
   def _visit_before_children(self, node, parent_token):
     col = getattr(node, 'col_offset', None)
@@ -60,7 +111,7 @@ class MarkTokens(object):
     # parent_token argument. The second value becomes the token argument of _visit_after_children.
     return (token or parent_token, token)
 
-  def _visit_after_children(self, node, parent_token, token):
+  def _visit_after_children(self, node, parent_token, token, children):
     # This processes the node generically first, after all children have been processed.
 
     # Get the first and last tokens that belong to children. Note how this doesn't assume that we
@@ -68,11 +119,14 @@ class MarkTokens(object):
     # assumption can fail (e.g. with return annotations).
     first = token
     last = None
-    for child in self._iter_children(node):
-      if not first or child.first_token.index < first.index:
-        first = child.first_token
-      if not last or child.last_token.index > last.index:
-        last = child.last_token
+    child_ranges = []
+    if children:
+      # Token index ranges of children in source order, for finding the tokens between them. The
+      # first of these also gives us the earliest token of any child.
+      child_ranges = sorted((c.first_token.index, c.last_token.index) for c in children)
+      if not first or child_ranges[0][0] < first.index:
+        first = self._code.tokens[child_ranges[0][0]]
+      last = max(children, key=_last_token_index).last_token
 
     # If we don't have a first token from _visit_before_children, and there were no children, then
     # use the parent's token as the first token.
@@ -86,76 +140,100 @@ class MarkTokens(object):
       last = self._find_last_in_stmt(last)
 
     # Capture any unmatched brackets.
-    first, last = self._expand_to_matching_pairs(first, last, node)
+    cls = node.__class__
+    may_have_brackets = cls.__name__ not in _bracket_free_class_names
+    if may_have_brackets:
+      first, last = self._expand_to_matching_pairs(first, last, child_ranges)
 
     # Give a chance to node-specific methods to adjust.
-    nfirst, nlast = self._methods.get(self, node.__class__)(node, first, last)
+    visitor = _visitors[cls]
+    if visitor is not None:
+      nfirst, nlast = visitor(self, node, first, last)
 
-    if (nfirst, nlast) != (first, last):
-      # If anything changed, expand again to capture any unmatched brackets.
-      nfirst, nlast = self._expand_to_matching_pairs(nfirst, nlast, node)
+      if may_have_brackets and (nfirst, nlast) != (first, last):
+        # If anything changed, expand again to capture any unmatched brackets.
+        nfirst, nlast = self._expand_to_matching_pairs(nfirst, nlast, child_ranges)
+      first, last = nfirst, nlast
 
-    node.first_token = nfirst
-    node.last_token = nlast
+    node.first_token = first
+    node.last_token = last
 
   def _find_last_in_stmt(self, start_token):
-    t = start_token
-    while (not util.match_token(t, token.NEWLINE) and
-           not util.match_token(t, token.OP, ';') and
-           not token.ISEOF(t.type)):
-      t = self._code.next_token(t, include_extra=True)
+    # Find the first NEWLINE, ';' or ENDMARKER token starting at start_token.
+    i = bisect.bisect_left(self._stmt_end_indices, start_token.index)
+    t = self._code.tokens[self._stmt_end_indices[i]]
     return self._code.prev_token(t)
 
-  def _expand_to_matching_pairs(self, first_token, last_token, node):
+  def _expand_to_matching_pairs(self, first_token, last_token, child_ranges):
     """
     Scan tokens in [first_token, last_token] range that are between node's children, and for any
-    unmatched brackets, adjust first/last tokens to include the closing pair.
+    unmatched brackets, adjust first/last tokens to include the closing pair. The children are
+    given as a sorted list of (first_index, last_index) token index pairs.
     """
+    start = first_token.index
+    end = last_token.index + 1
+
+    # Find the first bracket in range. Most ranges contain no brackets at all, which we can tell
+    # without scanning the tokens; otherwise, the scan can start at that bracket.
+    bracket_indices = self._bracket_indices
+    i = bisect.bisect_left(bracket_indices, start)
+    if i == len(bracket_indices) or bracket_indices[i] >= end:
+      return (first_token, last_token)
+    start = bracket_indices[i]
+
     # We look for opening parens/braces among non-child tokens (i.e. tokens between our actual
     # child nodes). If we find any closing ones, we match them to the opens.
     to_match_right = []
     to_match_left = []
-    for tok in self._code.token_range(first_token, last_token):
-      tok_info = tok[:2]
-      if to_match_right and tok_info == to_match_right[-1]:
-        to_match_right.pop()
-      elif tok_info in _matching_pairs_left:
-        to_match_right.append(_matching_pairs_left[tok_info])
-      elif tok_info in _matching_pairs_right:
-        to_match_left.append(_matching_pairs_right[tok_info])
+    bracket_codes = self._bracket_codes
+    next_token = self._code.next_token
+    prev_token = self._code.prev_token
+
+    # Walk the gaps between consecutive children, with an empty child at the end of our range to
+    # include the gap after the last child.
+    for (child_first, child_last) in itertools.chain(child_ranges, ((end, end),)):
+      for code in bracket_codes[start:min(child_first, end)]:
+        if not code:
+          continue
+        if code <= _CLOSE_OFFSET:
+          to_match_right.append(code)
+        elif to_match_right and code - _CLOSE_OFFSET == to_match_right[-1]:
+          to_match_right.pop()
+        else:
+          to_match_left.append(code - _CLOSE_OFFSET)
+      start = max(start, child_last + 1)
+      if start >= end:
+        break
 
     # Once done, extend `last_token` to match any unclosed parens/braces.
-    for match in reversed(to_match_right):
-      last = self._code.next_token(last_token)
+    for code in reversed(to_match_right):
+      last = next_token(last_token)
       # Allow for trailing commas or colons (allowed in subscripts) before the closing delimiter
-      while any(util.match_token(last, token.OP, x) for x in (',', ':')):
-        last = self._code.next_token(last)
+      while last.type == _OP and last.string in (',', ':'):
+        last = next_token(last)
       # Now check for the actual closing delimiter.
-      if util.match_token(last, *match):
+      if util.match_token(last, _OP, _closing_brackets[code - 1]):
         last_token = last
 
     # And extend `first_token` to match any unclosed opening parens/braces.
-    for match in to_match_left:
-      first = self._code.prev_token(first_token)
-      if util.match_token(first, *match):
+    for code in to_match_left:
+      first = prev_token(first_token)
+      if util.match_token(first, _OP, _opening_brackets[code - 1]):
         first_token = first
 
     return (first_token, last_token)
 
   #----------------------------------------------------------------------
   # Node visitors. Each takes a preliminary first and last tokens, and returns the adjusted pair
-  # that will actually be assigned.
-
-  def visit_default(self, node, first_token, last_token):
-    # pylint: disable=no-self-use
-    # By default, we don't need to adjust the token we computed earlier.
-    return (first_token, last_token)
+  # that will actually be assigned. Nodes without a `visit_{node_type}` method keep the tokens we
+  # computed earlier.
 
   def handle_comp(self, open_brace, node, first_token, last_token):
     # For list/set/dict comprehensions, we only get the token of the first child, so adjust it to
     # include the opening brace (the closing brace will be matched automatically).
     before = self._code.prev_token(first_token)
-    util.expect_token(before, token.OP, open_brace)
+    if __debug__:
+      util.expect_token(before, _OP, open_brace)
     return (before, last_token)
 
   # Python 3.8 fixed the starting position of list comprehensions:
@@ -164,7 +242,7 @@ class MarkTokens(object):
     def visit_listcomp(self, node, first_token, last_token):
       return self.handle_comp('[', node, first_token, last_token)
 
-  if six.PY2:
+  if sys.version_info[0] == 2:
     # We shouldn't do this on PY3 because its SetComp/DictComp already have a correct start.
     def visit_setcomp(self, node, first_token, last_token):
       return self.handle_comp('{', node, first_token, last_token)
@@ -175,19 +253,24 @@ class MarkTokens(object):
   def visit_comprehension(self, node, first_token, last_token):
     # The 'comprehension' node starts with 'for' but we only get first child; we search backwards
     # to find the 'for' keyword.
-    first = self._code.find_token(first_token, token.NAME, 'for', reverse=True)
+    first = self._code.find_token(first_token, _NAME, 'for', reverse=True)
     return (first, last_token)
 
   def visit_if(self, node, first_token, last_token):
+    prev_token = self._code.prev_token
     while first_token.string not in ('if', 'elif'):
-      first_token = self._code.prev_token(first_token)
+      first_token = prev_token(first_token)
     return first_token, last_token
 
   def handle_attr(self, node, first_token, last_token):
-    # Attribute node has ".attr" (2 tokens) after the last child.
-    dot = self._code.find_token(last_token, token.OP, '.')
+    # Attribute node has ".attr" (2 tokens) after the last child. The dot is nearly always the
+    # very next token, so check that before searching for it.
+    dot = self._code.next_token(last_token)
+    if not (dot.type == _OP and dot.string == '.'):
+      dot = self._code.find_token(last_token, _OP, '.')
     name = self._code.next_token(dot)
-    util.expect_token(name, token.NAME)
+    if __debug__:
+      util.expect_token(name, _NAME)
     return (first_token, name)
 
   visit_attribute = handle_attr
@@ -198,12 +281,12 @@ class MarkTokens(object):
     # With astroid, nodes that start with a doc-string can have an empty body, in which case we
     # need to adjust the last token to include the doc string.
     if not node.body and getattr(node, 'doc', None):
-      last_token = self._code.find_token(last_token, token.STRING)
+      last_token = self._code.find_token(last_token, _STRING)
 
     # Include @ from decorator
     if first_token.index > 0:
       prev = self._code.prev_token(first_token)
-      if util.match_token(prev, token.OP, '@'):
+      if util.match_token(prev, _OP, '@'):
         first_token = prev
     return (first_token, last_token)
 
@@ -217,7 +300,7 @@ class MarkTokens(object):
     # Remember that last_token is at the end of all children,
     # so we are not worried about encountering a bracket that belongs to a child.
     first_child = next(self._iter_children(node))
-    call_start = self._code.find_token(first_child.last_token, token.OP, opening_bracket)
+    call_start = self._code.find_token(first_child.last_token, _OP, opening_bracket)
     if call_start.index > last_token.index:
       last_token = call_start
     return last_token
@@ -228,7 +311,7 @@ class MarkTokens(object):
     # Handling a python bug with decorators with empty parens, e.g.
     # @deco()
     # def ...
-    if util.match_token(first_token, token.OP, '@'):
+    if util.match_token(first_token, _OP, '@'):
       first_token = self._code.next_token(first_token)
     return (first_token, last_token)
 
@@ -239,7 +322,7 @@ class MarkTokens(object):
   def handle_bare_tuple(self, node, first_token, last_token):
     # A bare tuple doesn't include parens; if there is a trailing comma, make it part of the tuple.
     maybe_comma = self._code.next_token(last_token)
-    if util.match_token(maybe_comma, token.OP, ','):
+    if maybe_comma.type == _OP and maybe_comma.string == ',':
       last_token = maybe_comma
     return (first_token, last_token)
 
@@ -268,10 +351,12 @@ class MarkTokens(object):
   def _gobble_parens(self, first_token, last_token, include_all=False):
     # Expands a range of tokens to include one or all pairs of surrounding parentheses, and
     # returns (first, last) tokens that include these parens.
+    prev_token = self._code.prev_token
+    next_token = self._code.next_token
     while first_token.index > 0:
-      prev = self._code.prev_token(first_token)
-      next = self._code.next_token(last_token)
-      if util.match_token(prev, token.OP, '(') and util.match_token(next, token.OP, ')'):
+      prev = prev_token(first_token)
+      next = next_token(last_token)
+      if util.match_token(prev, _OP, '(') and util.match_token(next, _OP, ')'):
         first_token, last_token = prev, next
         if include_all:
           continue
@@ -289,16 +374,18 @@ class MarkTokens(object):
 
   def handle_str(self, first_token, last_token):
     # Multiple adjacent STRING tokens form a single string.
-    last = self._code.next_token(last_token)
-    while util.match_token(last, token.STRING):
+    next_token = self._code.next_token
+    last = next_token(last_token)
+    while util.match_token(last, _STRING):
       last_token = last
-      last = self._code.next_token(last_token)
+      last = next_token(last_token)
     return (first_token, last_token)
 
   def handle_num(self, node, value, first_token, last_token):
     # A constant like '-1' gets turned into two tokens; this will skip the '-'.
-    while util.match_token(last_token, token.OP):
-      last_token = self._code.next_token(last_token)
+    next_token = self._code.next_token
+    while last_token.type == _OP:
+      last_token = next_token(last_token)
 
     if isinstance(value, complex):
       # A complex number like -2j cannot be compared directly to 0
@@ -307,7 +394,7 @@ class MarkTokens(object):
       value = value.imag
 
     # This makes sure that the - is included
-    if value < 0 and first_token.type == token.NUMBER:
+    if value < 0 and first_token.type == _NUMBER:
         first_token = self._code.prev_token(first_token)
     return (first_token, last_token)
 
@@ -318,7 +405,7 @@ class MarkTokens(object):
   def visit_const(self, node, first_token, last_token):
     if isinstance(node.value, numbers.Number):
       return self.handle_num(node, node.value, first_token, last_token)
-    elif isinstance(node.value, (six.text_type, six.binary_type)):
+    elif isinstance(node.value, _string_types):
       return self.visit_str(node, first_token, last_token)
     return (first_token, last_token)
 
@@ -331,31 +418,32 @@ class MarkTokens(object):
     # Until python 3.9 (https://bugs.python.org/issue40141),
     # ast.keyword nodes didn't have line info. Astroid has lineno None.
     if node.arg is not None and getattr(node, 'lineno', None) is None:
-      equals = self._code.find_token(first_token, token.OP, '=', reverse=True)
+      equals = self._code.find_token(first_token, _OP, '=', reverse=True)
       name = self._code.prev_token(equals)
-      util.expect_token(name, token.NAME, node.arg)
+      if __debug__:
+        util.expect_token(name, _NAME, node.arg)
       first_token = name
     return (first_token, last_token)
 
   def visit_starred(self, node, first_token, last_token):
     # Astroid has 'Starred' nodes (for "foo(*bar)" type args), but they need to be adjusted.
-    if not util.match_token(first_token, token.OP, '*'):
+    if not util.match_token(first_token, _OP, '*'):
       star = self._code.prev_token(first_token)
-      if util.match_token(star, token.OP, '*'):
+      if util.match_token(star, _OP, '*'):
         first_token = star
     return (first_token, last_token)
 
   def visit_assignname(self, node, first_token, last_token):
     # Astroid may turn 'except' clause into AssignName, but we need to adjust it.
-    if util.match_token(first_token, token.NAME, 'except'):
-      colon = self._code.find_token(last_token, token.OP, ':')
+    if util.match_token(first_token, _NAME, 'except'):
+      colon = self._code.find_token(last_token, _OP, ':')
       first_token = last_token = self._code.prev_token(colon)
     return (first_token, last_token)
 
-  if six.PY2:
+  if sys.version_info[0] == 2:
     # No need for this on Python3, which already handles 'with' nodes correctly.
     def visit_with(self, node, first_token, last_token):
-      first = self._code.find_token(first_token, token.NAME, 'with', reverse=True)
+      first = self._code.find_token(first_token, _NAME, 'with', reverse=True)
       return (first, last_token)
 
   # Async nodes should typically start with the word 'async'
@@ -371,7 +459,34 @@ class MarkTokens(object):
   visit_asyncwith = handle_async
 
   def visit_asyncfunctiondef(self, node, first_token, last_token):
-    if util.match_token(first_token, token.NAME, 'def'):
+    if util.match_token(first_token, _NAME, 'def'):
       # Include the 'async' token
       first_token = self._code.prev_token(first_token)
     return self.visit_functiondef(node, first_token, last_token)
+
+
+class _VisitorTable(dict):
+  """
+  Maps node classes to the `visit_{node_type}` methods of visitor_cls (as unbound methods, taking
+  the visitor instance as the first argument), using the lowercase name of the class as node_type.
+  Classes without such a method map to None. Classes from the `ast` module are resolved up front;
+  any others (e.g. from `astroid`) are resolved the first time they are looked up.
+  """
+  def __init__(self, visitor_cls):
+    super(_VisitorTable, self).__init__()
+    self._visitor_cls = visitor_cls
+    stack = [ast.AST]
+    while stack:
+      node_cls = stack.pop()
+      self[node_cls] = self._resolve(node_cls)
+      stack.extend(node_cls.__subclasses__())
+
+  def __missing__(self, node_cls):
+    method = self[node_cls] = self._resolve(node_cls)
+    return method
+
+  def _resolve(self, node_cls):
+    return getattr(self._visitor_cls, 'visit_' + node_cls.__name__.lower(), None)
+
+
+_visitors = _VisitorTable(MarkTokens)